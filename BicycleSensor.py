@@ -1,7 +1,11 @@
 import argparse
+import atexit
 import csv
+import gzip
+import json
 import logging
 import os
+import queue
 import shutil
 import signal
 import sys
@@ -11,9 +15,15 @@ import traceback
 from abc import ABC, abstractmethod
 from collections import deque
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import requests   # type: ignore
+from requests.adapters import HTTPAdapter   # type: ignore
+
+UPLOAD_URL = 'https://bicycledata.vti.se/api/sensor/update'
+MAX_OVERRUNS = 10 # missed deadlines in a row before run_periodically warns
+WRITE_QUEUE_SIZE = 100_000 # rows waiting for the writer thread; the oldest are dropped beyond this
+SYNC_INTERVAL = 5.0 # seconds between syncs of the open file to disk
 
 
 def configure_logging(stdout: bool = True, 
@@ -53,25 +63,29 @@ def configure_logging(stdout: bool = True,
             maxBytes=5 * 1024 * 1024,  # 5 MB
             backupCount=2
         )
-        handler.setFormatter(formatter)
 
         # Roll over if the file already exists
         if log_exists:
             handler.doRollover()
-
-        logging.getLogger().addHandler(handler)
     else:
-        logging.basicConfig(
-            filename=log_file,
-            level=logging.INFO,
-            format=log_format
-        )
+        handler = logging.FileHandler(filename=log_file, mode='a')
+    handler.setFormatter(formatter)
+    handlers = [handler]
 
     # Optionally, log to stdout
     if stdout:
         stream_handler = logging.StreamHandler()
         stream_handler.setFormatter(formatter)
-        logging.getLogger().addHandler(stream_handler)
+        handlers.append(stream_handler)
+
+    # The handlers run in a background thread; code logging from the
+    # measurement loop only puts the record on a queue and never waits for
+    # file or console I/O.
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # write out queued records on exit
+    logging.getLogger().addHandler(QueueHandler(log_queue))
 
     # Convert log level string to numeric level
     numeric_level = getattr(logging, loglevel.upper(), None)
@@ -81,32 +95,62 @@ def configure_logging(stdout: bool = True,
     # Set the logging level for the root logger
     logging.getLogger().setLevel(numeric_level)
 
+    # A failing log handler must not raise in (or print tracebacks from) the
+    # measurement threads
+    logging.raiseExceptions = False
+
     # Log the command-line arguments
-    logging.getLogger().info(f'Command-line arguments: {sys.argv[1:]}')
+    logging.getLogger().info('Command-line arguments: %s', sys.argv[1:])
 
     return logging.getLogger()
 
 
 class BicycleSensor(ABC):
-    def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread=False):
+    # (minute, '%Y-%m-%d %H:%M:' string) of the last formatted timestamp
+    _timestamp_cache = (None, '')
+
+    def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread=False,
+                 compress_uploads=False):
         self._name = name
         self._hash = hash
         self._measurement_frequency = measurement_frequency
         self._upload_interval = upload_interval
         self._alive = True
         self._use_worker_thread = use_worker_thread # bool
+        self._compress_uploads = compress_uploads # bool, gzip the upload body
 
         # Create necessary directories
         os.makedirs('pending', exist_ok=True)
         os.makedirs('uploaded', exist_ok=True)
 
-        # Initialize the upload queue
-        self._upload_queue = deque(sorted([os.path.join('pending', f) 
-                                           for f in os.listdir('pending') 
-                                           if os.path.isfile(os.path.join('pending', f))]))
+        # Initialize the upload queue (scandir's is_file() needs no extra stat
+        # per file, which matters when many files piled up while offline)
+        with os.scandir('pending') as entries:
+            self._upload_queue = deque(sorted(entry.path for entry in entries if entry.is_file()))
+
+        # Keep one HTTPS connection alive between uploads instead of paying
+        # for a TCP+TLS handshake on every file
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
 
         self._file = None
-        self.upload_event = threading.Event()
+        # Rows are written to the file by a writer thread, so a slow SD card
+        # does not stall the threads taking measurements. The queue is bounded
+        # so a stalled card cannot use up the memory. The lock is held while
+        # the file is written or rotated.
+        self._file_lock = threading.Lock()
+        self._write_queue = deque(maxlen=WRITE_QUEUE_SIZE)
+        self._write_event = threading.Event() # set when rows are queued
+        self._header_thread = None # thread writing the header in trigger_upload()
+        self.write_thread = threading.Thread(target=self._write_loop)
+        self.write_thread.daemon = True # trigger_upload() writes out what is left
+        self.write_thread.start()
+
+        # trigger_upload() counts rotations under the condition and the upload
+        # thread resets the count, so no wake-up is lost while it is busy
+        self._upload_cv = threading.Condition()
+        self._pending_uploads = 0
+        self._uploads_stopped = False # set by main() after the final rotation
         self.upload_thread = threading.Thread(target=self._upload_data_loop)
         self.upload_thread.start()
 
@@ -147,55 +191,155 @@ class BicycleSensor(ABC):
     def write_to_file(self, data: str):
         """
         Helper method to write data to the file.
+
+        Rows are queued for the writer thread; only the header, written while
+        trigger_upload() holds the file, goes to the file directly so that it
+        is always the first line. Rows queued while the file is being rotated
+        go to the new file.
         """
+        row = (data + '\n').encode()
+        if self._header_thread == threading.get_ident():
+            self._file.write(row)
+        else:
+            self._write_queue.append(row)
+            self._write_event.set()
+
+    def _write_queued_rows(self):
+        """
+        Write the queued rows to the file. Called with _file_lock held.
+        """
+        if len(self._write_queue) == WRITE_QUEUE_SIZE:
+            logging.warning('Write queue full, the oldest rows may have been dropped')
+        rows = [self._write_queue.popleft() for _ in range(len(self._write_queue))]
         if self._file:
-            self._file.write(data)
-            self._file.write('\n')
+            # each row is copied straight into the file buffer, without
+            # joining them into one bytes object first
+            self._file.writelines(rows)
+
+    def _write_loop(self):
+        """
+        The loop that runs in a separate thread and writes queued rows to the
+        file, as many at a time as have piled up. The file is also synced to
+        disk every SYNC_INTERVAL seconds, so a power cut loses at most that
+        much data.
+        """
+        synced = time.monotonic()
+        while True:
+            self._write_event.wait(timeout=SYNC_INTERVAL)
+            self._write_event.clear()
+            try:
+                with self._file_lock:
+                    self._write_queued_rows()
+                    if self._file and time.monotonic() - synced >= SYNC_INTERVAL:
+                        # the data and the file size are what matter; skip the
+                        # timestamp-only metadata writes a full fsync adds
+                        self._file.flush()
+                        os.fdatasync(self._file.fileno())
+                        synced = time.monotonic()
+            except Exception as e:
+                logging.error("Error writing to '%s': %s", self._filename, e)
+
+    def timestamp(self, time_us=None):
+        """
+        Return the unix timestamp and its '%Y-%m-%d %H:%M:%S.%f' string for
+        `time_us` (microseconds since the epoch, defaults to now).
+
+        The date, hour and minute are formatted with strftime at most once per
+        minute; seconds and microseconds are formatted as integers on every
+        call. Local time offsets are whole minutes, so a local minute starts
+        whenever the unix time is a multiple of 60.
+        """
+        if time_us is None:
+            time_us = time.time_ns() // 1000
+        sec, us = divmod(time_us, 1_000_000)
+        minute, sec = divmod(sec, 60)
+        cached_minute, minute_str = self._timestamp_cache
+        if minute != cached_minute:
+            minute_str = time.strftime('%Y-%m-%d %H:%M:', time.localtime(minute * 60))
+            self._timestamp_cache = (minute, minute_str)
+        return time_us / 1_000_000, f'{minute_str}{sec:02d}.{us:06d}'
 
     def _handle_shutdown(self, signum, frame):
         """
         Gracefully handle shutdown signals.
         """
         self._alive = False
-        self.upload_event.set()  # ensure thread wakes up to check _alive flag
-        logging.warning(f'Shutdown due to signal {signum}')
+        logging.warning('Shutdown due to signal %s', signum)
 
     def trigger_upload(self):
         """
         Trigger the upload event.
         """
-        if self._file:
-            self._file.close()
-            self._file = None
-            self._upload_queue.append(self._filename)
-
-        self._filename = os.path.join('pending', datetime.now().strftime('%Y%m%d_%H%M%S.csv'))
-
-        if self._alive:
-            try:
-                self._file = open(self._filename, 'w')
-                self.write_header()
-                logging.info(f"New file '{self._filename}' created")
-            except IOError as e:
-                logging.error(f"Error opening file '{self._filename}': {e}")
+        with self._file_lock:
+            if self._file:
+                # the file is complete and durable before it is queued for
+                # upload
+                self._write_queued_rows()
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
                 self._file = None
-        self.upload_event.set()
+                self._upload_queue.append(self._filename)
+
+            self._filename = os.path.join('pending', datetime.now().strftime('%Y%m%d_%H%M%S.csv'))
+
+            if self._alive:
+                try:
+                    # Rows are small and frequent; let a large buffer collect them
+                    # and write to disk in big chunks (flushed by the periodic
+                    # sync and on rotation). Binary mode skips the text layer's
+                    # per-write newline and encoding handling.
+                    self._file = open(self._filename, 'wb', buffering=1 << 20)
+                    self._header_thread = threading.get_ident()
+                    try:
+                        self.write_header()
+                    finally:
+                        self._header_thread = None
+                    logging.info("New file '%s' created", self._filename)
+                except IOError as e:
+                    logging.error("Error opening file '%s': %s", self._filename, e)
+                    self._file = None
+
+        with self._upload_cv:
+            self._pending_uploads += 1
+            self._upload_cv.notify()
 
     def _upload_data_loop(self):
         """
         The main loop that runs in a separate thread to handle data uploads.
         """
-        while self._alive:
-            self.upload_event.wait()  # Wait until the event is set
-            self._upload_data()       # Perform the upload
-            self.upload_event.clear() # Reset the event to pause the thread
+        while True:
+            with self._upload_cv:
+                # also wake up once per upload interval without a rotation, so
+                # files left behind by a failed upload are retried even when
+                # no new file is queued
+                self._upload_cv.wait_for(lambda: self._pending_uploads or self._uploads_stopped,
+                                         timeout=self._upload_interval)
+                self._pending_uploads = 0
+                stopping = self._uploads_stopped
+
+            if stopping:
+                logging.warning('Upload thread stopped - final upload attempt')
+            self._upload_data()
+            if stopping:
+                break
 
-        # Final upload after shutdown
-        logging.warning('Upload thread stopped - final upload attempt')
-        self.trigger_upload()
-        self._upload_data()
         logging.warning('Upload thread stopped')
 
+    def _read_csv(self, filename):
+        """
+        Read a pending CSV file into a list of lines with a single pread().
+        """
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            data = os.pread(fd, os.fstat(fd).st_size, 0)
+            # the file is not read again once uploaded; drop it from the page
+            # cache instead of letting it crowd out pages that are still used
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+        return data.decode().splitlines(keepends=True)
+
     def _upload_data(self):
         """
         Perform the data upload to the server.
@@ -223,12 +367,18 @@ class BicycleSensor(ABC):
                     shutil.copyfile(filename, os.path.join(sensor_usb_path, filename.split("/")[-1]))
 
 
-                with open(filename, 'r') as file:
-                    csv_data = file.readlines()
+                csv_data = self._read_csv(filename)
 
-                r = requests.post('https://bicycledata.vti.se/api/sensor/update',
-                                  json={'hash': self._hash, 'sensor': self._name, 'csv_data': csv_data}, timeout=10)
-                logging.info(f'{r.status_code}: {filename}')
+                payload = {'hash': self._hash, 'sensor': self._name, 'csv_data': csv_data}
+                if self._compress_uploads:
+                    # CSV compresses well; level 3 is cheap enough for the RPi
+                    body = gzip.compress(json.dumps(payload).encode(), compresslevel=3)
+                    r = self._session.post(UPLOAD_URL, data=body, timeout=10,
+                                           headers={'Content-Type': 'application/json',
+                                                    'Content-Encoding': 'gzip'})
+                else:
+                    r = self._session.post(UPLOAD_URL, json=payload, timeout=10)
+                logging.info('%s: %s', r.status_code, filename)
 
                 if r.status_code == 200:
                     shutil.move(filename, 'uploaded')
@@ -240,30 +390,71 @@ class BicycleSensor(ABC):
             logging.error("Something went wrong during the upload process")
             logging.error(traceback.format_exc())
 
-    def main(self):
+    def run_periodically(self, func, frequency):
         """
-        Main loop for handling sensor measurements and triggering uploads.
+        Call `func` `frequency` times per second until shutdown.
+
+        Sleeps until fixed deadlines rather than for a fixed period, so the
+        time spent in `func` does not lower the rate or make it drift. The
+        deadlines are whole nanoseconds on the monotonic clock, counted from
+        the start, so clock adjustments and float rounding cannot shift them.
         """
-        _time = time.time()
+        period = round(1_000_000_000 / frequency) # ns
+        start = time.monotonic_ns()
+        n = 1 # deadline of the current iteration is start + n * period
+        overruns = 0 # consecutive iterations that finished past their deadline
 
         while self._alive:
             try:
-                self.write_measurement()
-
-                current_time = time.time()
-                if current_time - _time >= self._upload_interval:
-                    _time = current_time
-                    self.trigger_upload()
-
-                time.sleep(1.0 / self._measurement_frequency)
+                func()
             except Exception as e:
-                logging.error(f"Error during main loop: {e}")
+                logging.error("Error during %s: %s", func.__name__, e)
                 logging.error(traceback.format_exc())
 
-        # Trigger final upload and clean up
-        if self._file:
+            now = time.monotonic_ns()
+            delay = start + n * period - now
+            if delay > 0:
+                time.sleep(delay / 1_000_000_000)
+                overruns = 0
+            else:
+                overruns += 1
+                if overruns == MAX_OVERRUNS:
+                    logging.warning("%s cannot keep up with %s Hz: %d deadlines missed in a row",
+                                    func.__name__, frequency, overruns)
+            n += 1
+            if delay < -period:
+                # more than a period behind (e.g. a stall); don't try to catch up
+                start, n = now, 1
+
+    def _measure(self):
+        """
+        One iteration of the main loop: write a measurement and rotate the
+        file once the upload interval has passed.
+        """
+        self.write_measurement()
+
+        current_time = time.monotonic()
+        if current_time - self._upload_time >= self._upload_interval:
+            self._upload_time = current_time
             self.trigger_upload()
 
-        # Wait for the upload thread to finish
-        self.upload_thread.join()
+    def main(self):
+        """
+        Main loop for handling sensor measurements and triggering uploads.
+        """
+        self._upload_time = time.monotonic()
+        self.run_periodically(self._measure, self._measurement_frequency)
+
+        # Trigger final upload and clean up
+        try:
+            if self._file:
+                self.trigger_upload()
+        finally:
+            # Let the upload thread make its final attempt, then wait for it.
+            # This must happen even if closing the last file failed, or the
+            # upload thread keeps the process alive.
+            with self._upload_cv:
+                self._uploads_stopped = True
+                self._upload_cv.notify()
+            self.upload_thread.join()
         logging.warning('Process stopped')
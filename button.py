@@ -6,6 +6,10 @@
   Purpose:
     Monitor a button press.
 
+    The pin is not polled: the worker thread blocks on edges of the pin and
+    writes a row with the new state whenever the button is pressed or
+    released.
+
   Note:
     Use GPIO22 pin and the neighbouring 3V3 pin.
 
@@ -35,25 +39,53 @@ import argparse
 import asyncio
 import logging
 import datetime, time
+import traceback
 
 import RPi.GPIO as GPIO   # type: ignore
 
 from BicycleSensor import BicycleSensor, configure_logging
 
 SENSOR_NAME="VTIButton"
+BOUNCE_TIME=0.02 # seconds for the contacts to settle after an edge
+ERROR_DELAY=1.0 # seconds to wait after an error before waiting for edges again
 
 class ButtonSensor(BicycleSensor):
 
-  def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread):
-    BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread)
-    
+  def __init__(self, name, hash, measurement_frequency, upload_interval, compress_uploads=False):
     self.PIN = 22                                                 # use GPIO 22
 
     GPIO.setmode(GPIO.BCM)                                        # use GPIO numbering
     GPIO.setup(self.PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)     # set GPIO 22 as input
 
-  async def worker_main(self):
-      pass 
+    # button changes are recorded by the worker thread, see worker_main()
+    BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread=True,
+                           compress_uploads=compress_uploads)
+
+  def worker_main(self):
+    '''
+    Wait for the button pin to change (kernel edge detection) and write a row
+    with the new state for every press and release.
+
+    The contacts bounce, so the state is read once they have settled and a
+    row is only written when it differs from the last one.
+    '''
+    state = None # last state written
+    while self._alive:
+      try:
+        if GPIO.wait_for_edge(self.PIN, GPIO.BOTH, timeout=1000) is None:
+          continue # timed out, check if we are still alive
+        dt_unix, dt_str = self.timestamp() # time of the first edge
+        time.sleep(BOUNCE_TIME)
+        new_state = 1 if GPIO.input(self.PIN) else 0
+        if new_state == state:
+          continue # bounce, or a press shorter than BOUNCE_TIME
+        state = new_state
+        logging.debug("timestamp: %s", dt_str)
+        self.write_to_file(f"{dt_unix}\t{dt_str}\t{state}")
+      except Exception as e:
+        logging.error("Error reading the button: %s", e)
+        logging.error(traceback.format_exc())
+        time.sleep(ERROR_DELAY)
 
   def write_header(self):
     '''Override to write the header to the CSV file.'''
@@ -61,13 +93,8 @@ class ButtonSensor(BicycleSensor):
     self.write_to_file("unix_timestamp\tdatetime\tbutton")
 
   def write_measurement(self):
-    '''Override to write measurement data to the CSV file.'''
-    dt = datetime.datetime.now()
-    dt_str = dt.strftime("%Y-%m-%d %H:%M:%S.%f")
-    dt_unix = dt.timestamp()
-    logging.info("timestamp: " + dt_str)
-    data_row = f"{dt_unix}\t{dt_str}\t{1 if GPIO.input(self.PIN) else 0}"
-    self.write_to_file(data_row)
+    '''Button changes are written by worker_main(), nothing to poll here.'''
+    pass
 
 if __name__ == '__main__':
 
@@ -80,14 +107,14 @@ if __name__ == '__main__':
   PARSER.add_argument('--hash', type=str, required=True, help='[required] hash of the device')
   PARSER.add_argument('--name', type=str, default=SENSOR_NAME, help='[required] name of the sensor')
   PARSER.add_argument('--loglevel', type=str, default='DEBUG', help='Set the logging level (e.g., DEBUG, INFO, WARNING)')
-  PARSER.add_argument('--measurement-frequency', type=float, default=50.0, help='Frequency of sensor measurements in 1/s')
+  PARSER.add_argument('--measurement-frequency', type=float, default=1.0, help='Not utilized')
   PARSER.add_argument('--stdout', action='store_true', help='Enables logging to stdout')
   PARSER.add_argument('--upload-interval', type=float, default=5.0, help='Interval between uploads in seconds')
-  PARSER.add_argument('--use_worker_thread', type=bool, default=False, help='Use a background thread for worker process or not')
+  PARSER.add_argument('--compress-uploads', action='store_true', help='Send uploads gzip-compressed')
   ARGS = PARSER.parse_args()
 
   # Configure logging
   configure_logging(stdout=ARGS.stdout, rotating=True, loglevel=ARGS.loglevel, logfile=f"{SENSOR_NAME}.log")
 
-  button_sensor = ButtonSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.use_worker_thread)
+  button_sensor = ButtonSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.compress_uploads)
   button_sensor.main()
@@ -29,7 +29,9 @@
 import argparse
 import asyncio
 import logging
+import queue
 import smbus2 as smbus
+from smbus2 import i2c_msg
 import datetime, time
 
 from BicycleSensor import BicycleSensor, configure_logging
@@ -38,9 +40,7 @@ SENSOR_NAME="VTIGarminLidarLiteV3"
 
 class LidarSensor(BicycleSensor):
 
-  def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread):
-    BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread)
-
+  def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread, compress_uploads=False):
     self.BUS = 1 # on RPi5, it's bus no.1 - can check with `ls /dev/*i2c*`
     self.ADDRESS = 0x62 # get with `sudo i2cdetect -y 1`
     self.DISTANCE_WRITE_REGISTER = 0x00
@@ -48,25 +48,28 @@ class LidarSensor(BicycleSensor):
     self.DISTANCE_READ_REGISTER_1 = 0x8f
     self.DISTANCE_READ_REGISTER_2 = 0x10
 
+    # I2C messages are built once and reused for every reading
+    self._msg_trigger = i2c_msg.write(self.ADDRESS, [self.DISTANCE_WRITE_REGISTER, self.DISTANCE_WRITE_VALUE])
+    self._msg_select = i2c_msg.write(self.ADDRESS, [self.DISTANCE_READ_REGISTER_1])
+    self._msg_read = i2c_msg.read(self.ADDRESS, 2)
+
+    # (time in microseconds, distance) acquired by the worker thread
+    self._samples = queue.SimpleQueue()
+
     try:
       self.actual_bus = smbus.SMBus(self.BUS)
     except:
-      logging.error(f"Not able ot instantiate bus number {self.BUS}")
+      logging.error("Not able ot instantiate bus number %s", self.BUS)
       raise
 
-  def writeAndWait(self):
-    self.actual_bus.write_byte_data(self.ADDRESS, self.DISTANCE_WRITE_REGISTER, self.DISTANCE_WRITE_VALUE);
-    #time.sleep(0.01)
-
-  def readDistAndWait(self):
-    reading = self.actual_bus.read_i2c_block_data(self.ADDRESS, self.DISTANCE_READ_REGISTER_1, 2)
-    # time.sleep(0.01)
-    return (reading[0] << 8 | reading[1])
+    # the bus has to be ready before the worker thread starts reading it
+    BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread, compress_uploads)
 
   def getDistance(self):
-    self.writeAndWait()
-    dist = self.readDistAndWait()
-    return dist # in cm
+    # trigger a measurement, select the distance register and read both bytes
+    # in one combined transaction (repeated start, no stop in between)
+    self.actual_bus.i2c_rdwr(self._msg_trigger, self._msg_select, self._msg_read)
+    return int.from_bytes(bytes(self._msg_read), 'big') # in cm
 
   def write_header(self):
     '''Override to write the header to the CSV file.'''
@@ -75,16 +78,33 @@ class LidarSensor(BicycleSensor):
 
   def write_measurement(self):
     '''Override to write measurement data to the CSV file.'''
-    distance = str(self.getDistance()) # in cm
-    dt = datetime.datetime.now()
-    dt_str = dt.strftime("%Y-%m-%d %H:%M:%S.%f")
-    dt_unix = dt.timestamp()
-    logging.info("timestamp: " + dt_str)
+    if self._use_worker_thread:
+      # write out what the worker thread acquired since the last call
+      while True:
+        try:
+          self.write_sample(*self._samples.get_nowait())
+        except queue.Empty:
+          break
+    else:
+      distance = self.getDistance() # in cm
+      self.write_sample(time.time_ns() // 1000, distance)
+
+  def write_sample(self, time_us, distance):
+    dt_unix, dt_str = self.timestamp(time_us)
+    logging.debug("timestamp: %s", dt_str)
     data_row = f"{dt_unix}\t{dt_str}\t{distance}"
     self.write_to_file(data_row)
 
-  async def worker_main(self):
-      pass 
+  def acquire(self):
+    distance = self.getDistance() # in cm
+    self._samples.put((time.time_ns() // 1000, distance))
+
+  def worker_main(self):
+    '''
+    With --use_worker_thread, read the sensor in the worker thread so the I2C
+    timing is not held up by file writes and uploads in the main loop.
+    '''
+    self.run_periodically(self.acquire, self._measurement_frequency)
 
 if __name__ == '__main__':
 
@@ -100,11 +120,12 @@ if __name__ == '__main__':
   PARSER.add_argument('--measurement-frequency', type=float, default=50.0, help='Frequency of sensor measurements in 1/s')
   PARSER.add_argument('--stdout', action='store_true', help='Enables logging to stdout')
   PARSER.add_argument('--upload-interval', type=float, default=300.0, help='Interval between uploads in seconds')
-  PARSER.add_argument('--use_worker_thread', type=bool, default=False, help='Use a background thread for worker process or not')
+  PARSER.add_argument('--compress-uploads', action='store_true', help='Send uploads gzip-compressed')
+  PARSER.add_argument('--use_worker_thread', action='store_true', help='Read the sensor in a background thread')
   ARGS = PARSER.parse_args()
 
   # Configure logging
   configure_logging(stdout=ARGS.stdout, rotating=True, loglevel=ARGS.loglevel, logfile=f"{SENSOR_NAME}.log")
 
-  lidar_sensor = LidarSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.use_worker_thread)
+  lidar_sensor = LidarSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.use_worker_thread, ARGS.compress_uploads)
   lidar_sensor.main()
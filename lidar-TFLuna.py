@@ -7,45 +7,87 @@
 
     NOTE:
     =====
-    Using 120Hz measurement-frequency because each time there is a 0.01s wait
-    before taking a reading. So overall (with additional processing times) it
-    works out to ~50Hz data frequency.
+    The sensor needs ~0.01s to answer the data command. The command for the
+    next reading is sent right after each read, so that wait overlaps with the
+    rest of the measurement loop instead of stalling it (only the part of the
+    0.01s that has not yet elapsed is slept off).
 """
 
 import argparse
+import ctypes
 import logging
+import queue
+import struct
 import smbus2 as smbus
+from smbus2 import i2c_msg
 import datetime, time
 
 from BicycleSensor import BicycleSensor, configure_logging
 
-class LidarSensor(BicycleSensor):
+DATA_LENGTH=9 # bytes read back from register 0x00
+DATA_STRUCT=struct.Struct('<HHH') # little-endian distance, strength, temperature (in 0.01 ℃)
 
-    def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread):
-        BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread)
+class LidarSensor(BicycleSensor):
 
+    def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread, compress_uploads=False):
         self.BUS = 1 # on RPi5, it's bus no.1 - can check with `ls /dev/*i2c*`
         self.ADDRESS = 0x10 # get with `sudo i2cdetect -y 1`
         self.DATA_CMD = [0x5A,0x05,0x00,0x01,0x60] # Distance value instruction
+        self.DATA_DELAY = 0.01 # time the sensor needs to answer DATA_CMD (in seconds)
+        self.DATA_MAX_AGE = 0.05 # re-send DATA_CMD if the pending one is older than this
+        self._cmd_time = None # time.monotonic() of the pending DATA_CMD
+        self._cmd_time_us = None # wall-clock time of the pending DATA_CMD (in microseconds)
+
+        # I2C messages are built once and reused for every reading; the answer
+        # is parsed straight out of the read message's buffer
+        self._msg_cmd = i2c_msg.write(self.ADDRESS, [0x00] + self.DATA_CMD)
+        self._msg_select = i2c_msg.write(self.ADDRESS, [0x00])
+        self._msg_read = i2c_msg.read(self.ADDRESS, DATA_LENGTH)
+        self._read_view = ctypes.cast(self._msg_read.buf, ctypes.POINTER(ctypes.c_char * DATA_LENGTH)).contents
+
+        # (time in microseconds, (distance, strength, temperature)) acquired
+        # by the worker thread
+        self._samples = queue.SimpleQueue()
 
         try:
             self.actual_bus = smbus.SMBus(self.BUS)
         except:
-            logging.error(f"Not able ot instantiate bus number {self.BUS}")
+            logging.error("Not able ot instantiate bus number %s", self.BUS)
             raise
 
-    async def worker_main(self):
-        pass 
+        # the bus has to be ready before the worker thread starts reading it
+        BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread, compress_uploads)
+
+    def acquire(self):
+        self._samples.put(self.get_data())
+
+    def worker_main(self):
+        """
+        With --use_worker_thread, read the sensor in the worker thread so the
+        I2C timing is not held up by file writes and uploads in the main loop.
+        """
+        self.run_periodically(self.acquire, self._measurement_frequency)
+
+    def send_command(self):
+        self.actual_bus.i2c_rdwr(self._msg_cmd)
+        self._cmd_time = time.monotonic()
+        self._cmd_time_us = time.time_ns() // 1000
 
     def get_data(self):
-        self.actual_bus.write_i2c_block_data(self.ADDRESS, 0x00, self.DATA_CMD)
-        time.sleep(0.01)
-        data = self.actual_bus.read_i2c_block_data(self.ADDRESS, 0x00, 9)
-        distance = data[0] | (data[1] << 8)
-        strength = data[2] | (data[3] << 8)
-        temperature = (data[4] | (data[5] << 8)) / 100 
+        # The command for this reading is normally sent at the end of the
+        # previous call, so the answer is usually ready by now. The reading is
+        # stamped with the time of its command, not with the time it is read.
+        if self._cmd_time is None or time.monotonic() - self._cmd_time > self.DATA_MAX_AGE:
+            self.send_command()
+        remaining = self.DATA_DELAY - (time.monotonic() - self._cmd_time)
+        if remaining > 0:
+            time.sleep(remaining)
+        self.actual_bus.i2c_rdwr(self._msg_select, self._msg_read)
+        distance, strength, temperature = DATA_STRUCT.unpack_from(self._read_view)
+        time_us = self._cmd_time_us
+        self.send_command() # request the next reading
         # print('distance = %5d cm, strength = %5d, temperature = %5d ℃'%(distance, strengh, temperature))
-        return (distance, strength, temperature)
+        return time_us, (distance, strength, temperature / 100)
 
 
     def write_header(self):
@@ -53,13 +95,21 @@ class LidarSensor(BicycleSensor):
         self.write_to_file("unix_timestamp\tdatetime\tdistance\tstrength\ttemperature")
 
     def write_measurement(self):
-        distance, strength, temperature = self.get_data()
-        dt = datetime.datetime.now()
-        # time.sleep(0.01)
+        if self._use_worker_thread:
+            # write out what the worker thread acquired since the last call
+            while True:
+                try:
+                    self.write_sample(*self._samples.get_nowait())
+                except queue.Empty:
+                    break
+        else:
+            self.write_sample(*self.get_data())
+
+    def write_sample(self, time_us, data):
+        distance, strength, temperature = data
         # create timestamp
-        dt_str = dt.strftime("%Y-%m-%d %H:%M:%S.%f")
-        dt_unix = dt.timestamp()
-        logging.info("timestamp: " + dt_str)
+        dt_unix, dt_str = self.timestamp(time_us)
+        logging.debug("timestamp: %s", dt_str)
         # write data
         data_row = f"{dt_unix}\t{dt_str}\t{distance}\t{strength}\t{temperature}"
         self.write_to_file(data_row)
@@ -78,11 +128,12 @@ if __name__ == '__main__':
     PARSER.add_argument('--measurement-frequency', type=float, default=120.0, help='Frequency of sensor measurements in 1/s')
     PARSER.add_argument('--stdout', action='store_true', help='Enables logging to stdout')
     PARSER.add_argument('--upload-interval', type=float, default=300.0, help='Interval between uploads in seconds')
-    PARSER.add_argument('--use_worker_thread', type=bool, default=False, help='Use a background thread for worker process or not')
+    PARSER.add_argument('--compress-uploads', action='store_true', help='Send uploads gzip-compressed')
+    PARSER.add_argument('--use_worker_thread', action='store_true', help='Read the sensor in a background thread')
     ARGS = PARSER.parse_args()
 
     # Configure logging
     configure_logging(stdout=ARGS.stdout, rotating=True, loglevel=ARGS.loglevel, logfile="VTITFLunaLidar.log")
 
-    lidar_sensor = LidarSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.use_worker_thread)
+    lidar_sensor = LidarSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.use_worker_thread, ARGS.compress_uploads)
     lidar_sensor.main()
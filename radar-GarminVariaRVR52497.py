@@ -40,7 +40,7 @@ import argparse
 import asyncio
 import logging
 import smbus2 as smbus
-import datetime, time
+import time
 
 from bleak import BleakScanner, BleakClient
 from bleak.backends.characteristic import BleakGATTCharacteristic
@@ -49,27 +49,23 @@ from BicycleSensor import BicycleSensor, configure_logging
 
 SENSOR_NAME="VTIGarminVariaRVR52497"
 SENSOR_ADDRESS="F7:ED:94:CC:95:AE"
-
-def bin2dec(n):
-    """
-    Convert floating point binary (exponent=-2) to decimal float.
-    """
-    fractional_part = 0.0
-    if n & 1 > 0:
-        fractional_part += 0.25
-    if n & 2 > 0:
-        fractional_part += 0.5
-    return fractional_part + (n>>2)
+MAX_TARGETS=6 # targets per notification, 3 bytes each (info, range, speed)
+TARGET_ID_MASK=0b11111100 # mask that reveals first 6 bits; use '&' with value
+BIN8=tuple(format(n, '08b') for n in range(256)) # 8-digit binary string of every byte value
+# CSV row with each target column written like a Python list, e.g. [4, 0, 0, 0, 0, 0]
+ROW_FORMAT="%s\t%s\t" + "\t".join(["[" + ", ".join(["%" + f]*MAX_TARGETS) + "]" for f in "ddrr"])
+RECONNECT_DELAY=1.0 # seconds before the first reconnect, doubled per failure
+MAX_RECONNECT_DELAY=60.0 # seconds
 
 
 class RadarSensor(BicycleSensor):
 
-    def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread):
+    def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread, compress_uploads=False):
         
         self.ADDRESS = SENSOR_ADDRESS
         self.CHAR_UUID = "6a4e3203-667b-11e3-949a-0800200c9a66" # same for all Varias
         
-        BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread)
+        BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread, compress_uploads)
 
     
     def write_header(self):
@@ -93,50 +89,67 @@ class RadarSensor(BicycleSensor):
         CSV row and prints it into a file.
         """
         
-        dt = datetime.datetime.now()
-        dt_str = dt.strftime("%Y-%m-%d %H:%M:%S.%f")
-        dt_unix = dt.timestamp()
-        target_id_mask = 0b11111100 # mask that reveals first 6 bits; use '&' with value
-        target_ids = [0 for x in range(6)]
-        target_ranges = [0 for x in range(6)] # 6 targets, each 3 bytes (info, range, speed)
-        target_speeds = [0.0 for x in range(6)]
-        bin_target_speeds = ["" for x in range(6)]
-
-        # data is a bytearray
-        intdata = [x for x in data]
-        j = 0 # target index
-        for i, dat in enumerate(intdata[1:]): # ignore flags in pos 0
-            if i%3 == 0: # each target has 3 bytes
-                j = i//3
-                target_ids[j] = (dat & target_id_mask)
-            elif i%3 == 1:
-                target_ranges[j] = dat
-            else: 
-                target_speeds[j] = bin2dec(dat)
-                bin_target_speeds[j] = format(dat, '08b')
-
-        data_row = f"{dt_unix}\t{dt_str}\t{target_ids}\t{target_ranges}\t{target_speeds}\t{bin_target_speeds}"
-        logging.info(data_row)
+        dt_unix, dt_str = self.timestamp()
+        # data is a bytearray: <flags>, then (info, range, speed) per target;
+        # each field is picked out for all targets with one strided view,
+        # so no bytes are copied before the values are read
+        targets = memoryview(data)[1:1 + 3*MAX_TARGETS] # ignore flags in pos 0
+        infos, ranges, speeds = targets[0::3], targets[1::3], targets[2::3]
+        target_ids = [info & TARGET_ID_MASK for info in infos] + [0]*(MAX_TARGETS - len(infos))
+        target_ranges = list(ranges) + [0]*(MAX_TARGETS - len(ranges))
+        # speed is fixed point with 2 fractional bits (resolution 0.25 m/s)
+        target_speeds = [speed * 0.25 for speed in speeds] + [0.0]*(MAX_TARGETS - len(speeds))
+        bin_target_speeds = [BIN8[speed] for speed in speeds] + [""]*(MAX_TARGETS - len(speeds))
+
+        data_row = ROW_FORMAT % (dt_unix, dt_str, *target_ids, *target_ranges, *target_speeds, *bin_target_speeds)
+        logging.debug("data row: %s", data_row)
         self.write_to_file(data_row)
 
-    async def radar(self):
+    async def connect(self, device):
         """
-        Main radar function that coordinates communication with Varia radar.
+        Connect to the Varia and receive notifications until it disconnects
+        or the sensor shuts down.
         """
-
-        varia = await BleakScanner.find_device_by_address(self.ADDRESS)
-        
-        if varia is None:
-            logging.warning("Could not find device with %s", self.ADDRESS)
-            return
-
-        async with BleakClient(varia) as client:
+        disconnected = asyncio.Event()
+        async with BleakClient(device, disconnected_callback=lambda client: disconnected.set()) as client:
             logging.info("Connected.")
             
             await client.start_notify(self.CHAR_UUID, self.notification_handler)
-            # await asyncio.sleep(60.0)     # run for given time (in seconds)
-            await asyncio.Future()  # run indefinitely
-            # await client.stop_notify(RADAR_CHAR_UUID)  # use with asyncio.sleep()
+            while self._alive and not disconnected.is_set():
+                try:
+                    await asyncio.wait_for(disconnected.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass # check self._alive again
+
+        if self._alive:
+            logging.warning("Disconnected.")
+
+    async def radar(self):
+        """
+        Main radar function that coordinates communication with Varia radar.
+
+        Reconnects whenever the connection drops, waiting longer after each
+        failed attempt. The BLEDevice found by the scan is reused for
+        reconnecting and only looked up again after a failed connection.
+        """
+
+        varia = None
+        delay = RECONNECT_DELAY
+        while self._alive:
+            try:
+                if varia is None:
+                    varia = await BleakScanner.find_device_by_address(self.ADDRESS)
+                if varia is None:
+                    logging.warning("Could not find device with %s", self.ADDRESS)
+                else:
+                    await self.connect(varia)
+                    delay = RECONNECT_DELAY # was connected; back off anew
+            except Exception as e:
+                logging.error("Radar connection failed: %s", e)
+                varia = None
+
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, MAX_RECONNECT_DELAY)
 
 
 if __name__ == '__main__':
@@ -153,6 +166,7 @@ if __name__ == '__main__':
     PARSER.add_argument('--measurement-frequency', type=float, default=1.0, help='Not utilized')
     PARSER.add_argument('--stdout', action='store_true', help='Enables logging to stdout')
     PARSER.add_argument('--upload-interval', type=float, default=5.0, help='Interval between uploads in seconds')
+    PARSER.add_argument('--compress-uploads', action='store_true', help='Send uploads gzip-compressed')
     PARSER.add_argument('--use_worker_thread', type=bool, default=True, help='Use a background thread for worker process or not')
     ARGS = PARSER.parse_args()
 
@@ -166,5 +180,6 @@ if __name__ == '__main__':
                                ARGS.hash,
                                ARGS.measurement_frequency,
                                ARGS.upload_interval,
-                               ARGS.use_worker_thread)
+                               ARGS.use_worker_thread,
+                               ARGS.compress_uploads)
     radar_sensor.main()
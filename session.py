@@ -19,12 +19,12 @@ EPSILON=0.01
 
 class SessionSensor(BicycleSensor):
 
-    def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread):
+    def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread, compress_uploads=False):
         
         self.START = datetime.datetime.now()
         self.DELTA = datetime.timedelta(seconds=int(UPLOAD_INTERVAL))
         
-        BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread)
+        BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread, compress_uploads)
 
     async def worker_main(self):
         pass 
@@ -43,7 +43,7 @@ class SessionSensor(BicycleSensor):
         if rn - self.START < self.DELTA:
             dt_str = self.START.strftime("%Y-%m-%d %H:%M:%S.%f")
             dt_unix = self.START.timestamp()
-            logging.info("timestamp: " + dt_str)
+            logging.info("timestamp: %s", dt_str)
             data_row = f"{dt_unix}\t{dt_str}"
             self.write_to_file(data_row)
 
@@ -61,11 +61,12 @@ if __name__ == '__main__':
     PARSER.add_argument('--measurement-frequency', type=float, default=1/UPLOAD_INTERVAL-EPSILON, help='Frequency of sensor measurements in 1/s')
     PARSER.add_argument('--stdout', action='store_true', help='Enables logging to stdout')
     PARSER.add_argument('--upload-interval', type=float, default=UPLOAD_INTERVAL, help='Interval between uploads in seconds')
+    PARSER.add_argument('--compress-uploads', action='store_true', help='Send uploads gzip-compressed')
     PARSER.add_argument('--use_worker_thread', type=bool, default=False, help='Use a background thread for worker process or not')
     ARGS = PARSER.parse_args()
 
 # Configure logging
     configure_logging(stdout=ARGS.stdout, rotating=True, loglevel=ARGS.loglevel, logfile=f"{SENSOR_NAME}.log")
 
-    session_sensor = SessionSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.use_worker_thread)
+    session_sensor = SessionSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.use_worker_thread, ARGS.compress_uploads)
     session_sensor.main()
@@ -8,69 +8,147 @@ On RPi, install drop-in for RPi.GPIO with:
 sudo apt remove python3-rpi.gpio
 sudo apt install python3-rpi.lgpio
 ```
+
+With `--rt-core N`, the thread taking the readings is pinned to CPU core N and
+runs with SCHED_FIFO priority (needs root or CAP_SYS_NICE). Keep that core
+free of other work with the kernel command line in /boot/firmware/cmdline.txt,
+e.g. for core 3:
+```
+isolcpus=3 nohz_full=3 rcu_nocbs=3 irqaffinity=0-2
+```
 """
 
 import argparse
-import datetime
+import ctypes
 import logging
+import os
+import struct
+import time
+import traceback
 
 import RPi.GPIO as GPIO   # type: ignore
 
-from smbus2 import SMBus  # type: ignore
+from smbus2 import SMBus, i2c_msg  # type: ignore
 
 from BicycleSensor import BicycleSensor, configure_logging
 
 SENSOR_NAME="VTIUltrasound"
+RT_PRIORITY=80 # SCHED_FIFO priority of the measurement thread with --rt-core
+RANGE_LENGTH=2 # bytes per range reading
+RANGE_STRUCT=struct.Struct('>H') # big-endian distance in cm
+EDGE_TIMEOUT=0.2 # seconds to wait for the end of a range, about two ranges
+ERROR_DELAY=0.1 # seconds to wait after a failed reading, about one range
+# failed readings in a row between error logs; with an unplugged sensor each
+# one waits out EDGE_TIMEOUT and ERROR_DELAY, so this logs about once a minute
+ERROR_LOG_EVERY=int(60 / (EDGE_TIMEOUT + ERROR_DELAY))
 
 class UltrasoundSensor(BicycleSensor):
 
-  def __init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread):
-    BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread=False)
-
+  def __init__(self, name, hash, measurement_frequency, upload_interval, rt_core=None, compress_uploads=False):
+    self.RT_CORE = rt_core # CPU core for the measurement thread, None to leave it to the scheduler
     self.ADDRESS = 0x70
     self.PIN = 4 # GPIO numbering of the orange wire; plug it into GPIO pin 4
     self.bus = SMBus(1) # using SDA1 and SCL1
+
+    # I2C messages are built once and reused for every reading
+    self._msg_range = i2c_msg.write(self.ADDRESS, [0x51]) # the range command
+    self._msg_read = i2c_msg.read(self.ADDRESS, RANGE_LENGTH)
+    # view of the read buffer, so a reading is unpacked in place without
+    # copying it out of the message first
+    self._read_view = ctypes.cast(self._msg_read.buf, ctypes.POINTER(ctypes.c_char * RANGE_LENGTH)).contents
     
     GPIO.setmode(GPIO.BCM) # set up BCM (GPIO) numbering
     GPIO.setup(self.PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN) # set GPIO 4 as input
+
+    # readings are taken by the worker thread, see worker_main()
+    BicycleSensor.__init__(self, name, hash, measurement_frequency, upload_interval, use_worker_thread=True,
+                           compress_uploads=compress_uploads)
   
   def take_range(self):
 
-    self.bus.write_byte(self.ADDRESS, 0x51) # Write the sensor's address and the range command, 0x51
+    self.bus.i2c_rdwr(self._msg_range) # Write the sensor's address and the range command, 0x51
     #sleep(0.1) # Allow the sensor to process the readings with a ~100mS delay
 
   def report_range(self):
 
-    latest_range = self.bus.read_word_data(self.ADDRESS, 0xFF) # a command (0xFF) is required by syntax not the part
-    return str(((latest_range & 0xFF) << 8) + (latest_range >> 8)) # distance reading in cm (as a string)
+    # the part needs no register address, just a plain 2-byte read; the
+    # sensor sends the high byte first
+    self.bus.i2c_rdwr(self._msg_read)
+    return RANGE_STRUCT.unpack_from(self._read_view)[0] # distance reading in cm
 
   def write_header(self):
     '''Override to write the header to the CSV file.'''
-    logging.info("Writing a header to file...")
+    logging.debug("Writing a header to file...")
     self.write_to_file("unix_timestamp\tdatetime\tdistance")
 
-  def write_measurement(self):
+  def worker_main(self):
     """
-    Override to write measurement data to the CSV file.
-    
-    This function is called at 200Hz frequency. Each time, it waits till orange
-    pin is low and only then returns a reading. In effect, it's an adaptive
-    frequency with 1/200s precision.
+    Wait for the orange pin to go low (kernel edge detection), which means the
+    sensor has finished ranging, then read the distance, start the next range
+    and write a row. In effect, the sensor sets the sampling rate.
+
+    Every reading follows a falling edge, so the loop always blocks between
+    readings, also when it runs with SCHED_FIFO priority (--rt-core).
     """
-    
-    if GPIO.input(self.PIN): # if GPIO port 4 is On/1/True/High
-      logging.info("Pin " + str(self.PIN) + " is 1/GPIO.HIGH/True")
-    else:
-      distance = self.report_range()
-      logging.info("Port " + str(self.PIN) + " is 0/GPIO.LOW/False")
-      self.take_range() # do next cycle
-      # write record to data file 
-      dt = datetime.datetime.now()
-      dt_str = dt.strftime("%Y-%m-%d %H:%M:%S.%f")
-      dt_unix = dt.timestamp()
-      logging.info("timestamp: " + dt_str + ", distance: " + distance)
-      data_row = f"{dt_unix}\t{dt_str}\t{distance}"
-      self.write_to_file(data_row)
+    if self.RT_CORE is not None:
+      self.make_realtime(self.RT_CORE)
+
+    # look the functions used on every reading up once, not per iteration
+    pin = self.PIN
+    gpio_input, wait_for_edge, falling = GPIO.input, GPIO.wait_for_edge, GPIO.FALLING
+    report_range, take_range = self.report_range, self.take_range
+    timestamp, write_to_file = self.timestamp, self.write_to_file
+    debug = logging.debug
+    edge_timeout_ms = int(EDGE_TIMEOUT * 1000)
+
+    errors = 0 # failed readings in a row
+    while self._alive:
+      try:
+        # the pin is high while the sensor is ranging; a range takes about
+        # 100 ms, so a timeout means no range is running (at startup, or the
+        # edge fell before the wait started): start one and wait again
+        if wait_for_edge(pin, falling, timeout=edge_timeout_ms) is None:
+          if not gpio_input(pin):
+            take_range()
+          continue # check if we are still alive
+        distance = report_range()
+        debug("Port %d is 0/GPIO.LOW/False", pin)
+        take_range() # do next cycle
+        # write record to data file 
+        dt_unix, dt_str = timestamp()
+        debug("timestamp: %s, distance: %s", dt_str, distance)
+        write_to_file(f"{dt_unix}\t{dt_str}\t{distance}")
+        errors = 0
+      except Exception as e:
+        # e.g. an unplugged sensor, whose pin stays low: back off instead of
+        # retrying at once, and only log every ERROR_LOG_EVERY-th error
+        if errors % ERROR_LOG_EVERY == 0:
+          logging.error("Error reading the sensor (%d in a row): %s", errors + 1, e)
+          logging.error(traceback.format_exc())
+        errors += 1
+        time.sleep(ERROR_DELAY)
+
+  def make_realtime(self, core):
+    '''
+    Pin the calling thread to CPU `core` and give it SCHED_FIFO priority, so
+    it wakes up on the pin edge without waiting behind other threads.
+    '''
+    try:
+      os.sched_setaffinity(0, {core})
+      os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RT_PRIORITY))
+      logging.info("Measurement thread runs on core %d with SCHED_FIFO priority %d", core, RT_PRIORITY)
+    except OSError as e: # PermissionError without root/CAP_SYS_NICE
+      logging.warning("Could not make the measurement thread real-time on core %d: %s", core, e)
+
+  def write_measurement(self):
+    '''Readings are written by worker_main(), nothing to poll here.'''
+    pass
+
+  def close(self):
+    '''Release the I2C bus and the pin once the worker thread has stopped.'''
+    self.worker_thread.join() # returns within a wait_for_edge timeout after shutdown
+    self.bus.close()
+    GPIO.cleanup(self.PIN)
 
 
 if __name__ == '__main__':
@@ -83,14 +161,17 @@ if __name__ == '__main__':
 
   PARSER.add_argument('--hash', type=str, required=True, help='[required] hash of the device')
   PARSER.add_argument('--name', type=str, default=SENSOR_NAME, help='[required] name of the sensor')
-  PARSER.add_argument('--loglevel', type=str, default='DEBUG', help='Set the logging level (e.g., DEBUG, INFO, WARNING)')
-  PARSER.add_argument('--measurement-frequency', type=float, default=200.0, help='Frequency of sensor measurements in 1/s')
+  PARSER.add_argument('--loglevel', type=str, default='WARNING', help='Set the logging level (e.g., DEBUG, INFO, WARNING)')
+  PARSER.add_argument('--measurement-frequency', type=float, default=1.0, help='Not utilized')
   PARSER.add_argument('--stdout', action='store_true', help='Enables logging to stdout')
   PARSER.add_argument('--upload-interval', type=float, default=300.0, help='Interval between uploads in seconds')
+  PARSER.add_argument('--compress-uploads', action='store_true', help='Send uploads gzip-compressed')
+  PARSER.add_argument('--rt-core', type=int, default=None, help='Pin the measurement thread to this CPU core with SCHED_FIFO priority')
   ARGS = PARSER.parse_args()
 
   # Configure logging
   configure_logging(stdout=ARGS.stdout, rotating=True, loglevel=ARGS.loglevel, logfile=f"{SENSOR_NAME}.log")
 
-  ultrasound_sensor = UltrasoundSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval)
+  ultrasound_sensor = UltrasoundSensor(ARGS.name, ARGS.hash, ARGS.measurement_frequency, ARGS.upload_interval, ARGS.rt_core, ARGS.compress_uploads)
   ultrasound_sensor.main()
+  ultrasound_sensor.close()